@@ -15,24 +15,22 @@ Options:
 from __future__ import print_function
 
 import os
-import io
 import re
-import glob
 import sqlite3
 import shutil
+import sys
 
-from itertools import groupby
-from collections import namedtuple
-from operator import itemgetter
+from itertools import chain
+from concurrent.futures import ProcessPoolExecutor
 
-from typing import Iterable, Tuple
+from typing import Iterable, List, Optional, Tuple
 import bs4
 from docopt import docopt
 
 DOC_PATH = 'pebble-sdk.docset/Contents/Resources/Documents'
 
 INSERT_QUERY_TEMPLATE = """
-    INSERT OR IGNORE INTO searchIndex(name, type, path)
+    INSERT INTO searchIndex(name, type, path)
     VALUES (?,?,?)
 """
 
@@ -59,12 +57,12 @@ INFO_PLIST_TEMPLATE = """\
 
 join = os.path.join
 
-SearchIndexData = namedtuple('SearchIndexData', ['name', 'type', 'path'])
+# (name, type, path) row of the search index, in INSERT_QUERY_TEMPLATE order.
+SearchIndexData = Tuple[str, str, str]
 
 class HTMLParser:
     """ Doxygen HTML file parser
     """
-    Result = namedtuple('Result', ['name', 'type', 'path'])
 
     section_type_map = {
         'Function Documentation': 'Function',
@@ -74,151 +72,164 @@ class HTMLParser:
         'Macro Definition Documentation': 'Macro',
     }
 
-    sections_to_skip = [
-        'Detailed Description',
-        None,
-    ]
+    # Only the documentation contents are of interest, don't build the rest
+    # of the tree.
+    strainer = bs4.SoupStrainer('div', attrs={'class': 'contents'})
+
+    # Group headers, anchors and declarations, in document order.
+    elements_selector = (
+        'div.contents > h2.groupheader, '
+        'div.contents > a[id], '
+        'div.contents > div.memitem'
+    )
 
     def __init__(self, content, path):
-        self.content = content
+        # The raw page is not kept around, only the strained tree is.
         self.path = path
-        self.soup = bs4.BeautifulSoup(content, 'html.parser')
-
-    def sections_elements_iterator(self) -> Iterable[Tuple[str, bs4.PageElement]]:
-        contents_el = self.soup.find('div', attrs={'class': 'contents'})
-
-        group_name = None
-        for el in contents_el:
-            if is_tag(el) and is_group_header(el):
-                group_name = el.string
-            yield (group_name, el)
+        self.soup = bs4.BeautifulSoup(content, 'lxml', parse_only=self.strainer)
 
-    def parse_section(self, name: str, elements: Iterable[bs4.PageElement]) -> Iterable[SearchIndexData]:
-        if name in self.sections_to_skip:
-            return
-
-        type_ = self.section_type_map[name]
+    def parse(self) -> Iterable[SearchIndexData]:
+        # Bound once, this loop runs for every declaration of the page.
+        section_type = self.section_type_map.get
+        parse_decl = parse_declaration
+        page_path = self.path
+        memproto_attrs = {'class': 'memproto'}
+        memname_attrs = {'class': 'memname'}
 
+        type_ = None
         anchor_id = None
-        for element in elements:
-            if is_anchor(element):
-                anchor_id = element.get('id')
+        for element in self.soup.select(self.elements_selector):
+            name = element.name
+            if name == 'h2':
+                # Sections without a known type (e.g. "Detailed
+                # Description") are skipped.
+                type_ = section_type(element.string)
+                anchor_id = None
                 continue
-            if not is_declaration(element):
+            if type_ is None:
+                continue
+            if name == 'a':
+                anchor_id = element.get('id')
                 continue
 
             table_el = (element
-                .find('div', attrs={'class': 'memproto'})
-                .find('table', attrs={'class': 'memname'})
+                .find('div', attrs=memproto_attrs)
+                .find('table', attrs=memname_attrs)
             )
 
             declaration = table_el.text
 
-            obj_name = parse_declaration(type_=type_, text=declaration)
-
-            path = self.path
-            if anchor_id:
-                path += "#" + str(anchor_id)
+            obj_name = parse_decl(type_, declaration)
 
-            yield SearchIndexData(obj_name, type_, path)
+            path = page_path + "#" + anchor_id if anchor_id else page_path
 
-    def parse(self) -> Iterable[Result]:
-        for section_name, group in groupby(
-                self.sections_elements_iterator(),
-                key=itemgetter(0),
-                ):
-            elements = [t[1] for t in group]
-            for r in self.parse_section(section_name, elements):
-                yield r
+            yield (obj_name, type_, path)
 
 
 regexs = {
-    'last_word': re.compile(r'.*?(?P<name>\w+)\s*$', re.UNICODE | re.DOTALL),
+    'last_word': re.compile(r'.*?(?P<name>\w+)\s*\Z', re.UNICODE | re.DOTALL),
     'macro': re.compile(r'''
-            ^\s*
+            \s*
             \#define\s+
             (?P<name>\w+)\s+
-            .*
-            $
-        ''', re.VERBOSE | re.UNICODE | re.DOTALL),
+        ''', re.VERBOSE | re.UNICODE),
     'function': re.compile(r'''
-            ^
             \s*
             (?:(?P<fn_modifier>\w+)\s+)?
             (?P<fn_type>\w+(?:\s*\*)?)\s+
-            (?P<fn_name>\w+)\s*
-            \(
-            .*
-            $
-        ''', re.VERBOSE | re.UNICODE | re.DOTALL),
-    'typedef_function': re.compile(r'''
-            ^\s*
-            typedef\s+
-            (?P<fn_type>\w+)\s*
-            \(
-                \*\s+
-                (?P<fn_name>\w+)\s*
-            \)
-            \(
-            .*
-            $
-        ''', re.VERBOSE | re.UNICODE | re.DOTALL),
-    'typedef': re.compile(r'''
-            ^\s*
-            typedef\s+
-            .*?
             (?P<name>\w+)\s*
-            $
+            \(
+        ''', re.VERBOSE | re.UNICODE),
+    # Either the name of a function pointer typedef, or the last word.
+    'type': re.compile(r'''
+            (?:
+                \s*
+                typedef\s+
+                \w+\s*
+                \(
+                    \*\s+
+                    (?=\w+\s*\)\()
+            |
+                .*?
+                (?=\w+\s*\Z)
+            )
+            (?P<name>\w+)
         ''', re.VERBOSE | re.UNICODE | re.DOTALL),
 }
 
+# Matchers to try, in order, for each declaration type. Every pattern
+# exposes the declared identifier as the `name` group.
+declaration_matchers = {
+    'Function': (regexs['function'].match,),
+    'Struct': (regexs['last_word'].match,),
+    'Enum': (regexs['last_word'].match,),
+    'Macro': (regexs['macro'].match,),
+    'Type': (regexs['type'].match,),
+}
+
 
-def parse_declaration(type_: str, text: str) -> str:
-    if type_ == 'Function':
-        match = regexs['function'].match(text)
-        result = match.group('fn_name')
-    if type_ == 'Struct':
-        match = regexs['last_word'].match(text)
-        result = match.group('name')
-    if type_ == 'Enum':
-        match = regexs['last_word'].match(text)
-        result = match.group('name')
-    if type_ == 'Macro':
-        match = regexs['macro'].match(text)
-        result = match.group('name')
-    if type_ == 'Type':
-        match_fn = regexs['typedef_function'].match(text)
-        match = regexs['typedef'].match(text)
-        match_last_word = regexs['last_word'].match(text)
-        if match_fn:
-            result = match_fn.group('fn_name')
-        elif match:
-            result = match.group('name')
-        else:
-            result = match_last_word.group('name')
-
-    return result
-
-
-def is_tag(element: bs4.PageElement) -> bool:
-    return element.name is not None
-
-
-def is_group_header(element: bs4.PageElement) -> bool:
-    return is_tag(element) and 'groupheader' in element.get('class', ())
-
-
-def is_anchor(element: bs4.PageElement) -> bool:
-    return (is_tag(element)
-        and element.name == 'a'
-        # and 'anchor' in element.get('class', ())
-    )
+def scan_function(text: str) -> Optional[str]:
+    """ Identifier right before the opening parenthesis.
+    """
+    paren = text.find('(')
+    if paren < 0:
+        return None
+    head = text[:paren].rsplit(None, 1)
+    return head[-1].lstrip('*') if head else None
 
 
-def is_declaration(element: bs4.PageElement) -> bool:
-    return (is_tag(element)
-        and element.name == 'div' and 'memitem' in element.get('class', ())
-    )
+def scan_macro(text: str) -> Optional[str]:
+    """ Identifier right after `#define`.
+    """
+    tokens = text.split(None, 2)
+    if len(tokens) < 2 or tokens[0] != '#define':
+        return None
+    return tokens[1].partition('(')[0]
+
+
+def scan_last_word(text: str) -> Optional[str]:
+    """ Last whitespace-delimited token.
+    """
+    tokens = text.rsplit(None, 1)
+    return tokens[-1] if tokens else None
+
+
+def scan_typedef(text: str) -> Optional[str]:
+    """ Name of a function pointer typedef, or the last token.
+    """
+    if text.lstrip().startswith('typedef'):
+        start = text.find('(*')
+        if start >= 0:
+            end = text.find(')', start)
+            return text[start + 2:end].strip() if end >= 0 else None
+    return scan_last_word(text)
+
+
+# Straight-line scanners for the common declaration shapes. They are much
+# cheaper than the regular expressions, which are only used as a fallback
+# when a scanner does not come up with a valid identifier.
+declaration_scanners = {
+    'Function': scan_function,
+    'Struct': scan_last_word,
+    'Enum': scan_last_word,
+    'Macro': scan_macro,
+    'Type': scan_typedef,
+}
+
+
+def parse_declaration(type_: str, text: str,
+                      _scanners=declaration_scanners,
+                      _matchers=declaration_matchers) -> str:
+    name = _scanners[type_](text)
+    if name and name.isidentifier():
+        return name
+
+    for match in _matchers[type_]:
+        m = match(text)
+        if m:
+            return m.group('name')
+
+    raise ValueError('Cannot parse {} declaration: {!r}'.format(type_, text))
 
 
 def take_db(path: str) -> sqlite3.Connection:
@@ -242,13 +253,22 @@ def take_db(path: str) -> sqlite3.Connection:
             );
             '''
         )
+
+    return db
+
+
+def finalize_db(db: sqlite3.Connection) -> None:
+    """ Index the populated database
+    Building the index once over the final rows is cheaper than keeping it
+    up to date while bulk inserting.
+    :param db: the database
+    """
+    with db:
         db.execute('''
             CREATE UNIQUE INDEX anchor ON searchIndex (name, type, path);
             '''
         )
 
-    return db
-
 
 def db_path(start: str) -> str:
     return join(start, 'Contents', 'Resources', 'docSet.dsidx')
@@ -268,11 +288,22 @@ def setup_tree(input_path:str, output_path: str) -> None:
     shutil.copy('icon@2x.png', output_path)
 
 def init_plist(docset_path: str, arch: str):
-    with io.open(join(docset_path, 'Contents', 'Info.plist'),
-                 'wt', encoding='utf-8') as output_f:
+    with open(join(docset_path, 'Contents', 'Info.plist'),
+              'wt', encoding='utf-8') as output_f:
         output_f.write(INFO_PLIST_TEMPLATE.format(arch=arch))
 
 
+def parse_file(args: Tuple[str, str]) -> List[SearchIndexData]:
+    """ Parse a Doxygen group page
+    :param args: (page path, page path relative to the documents root) pair
+    :return: the search index entries of the page
+    """
+    file_path, relpath = args
+    # Let the parser sniff the encoding and decode the raw bytes itself.
+    with open(file_path, 'rb') as input_f:
+        return list(HTMLParser(input_f, relpath).parse())
+
+
 def main() -> None:
     arguments = docopt(__doc__)
 
@@ -287,22 +318,42 @@ def main() -> None:
 
     db = take_db(db_path(start=docset_path))
 
-    file_path_list = glob.glob(join(documents_path, arch.capitalize(), 'group__*.html'))
-
-    insert_data_list = []
-    for file_path in file_path_list:
-        relpath = os.path.relpath(file_path, start=documents_path)
-        with io.open(file_path, 'rt', encoding='utf-8') as input_f:
-            p = (HTMLParser(input_f, relpath)
-                .parse()
+    arch_path = join(documents_path, arch.capitalize())
+    try:
+        with os.scandir(arch_path) as entries:
+            # Sorted, so the index rows don't depend on directory order.
+            file_path_list = sorted(
+                entry.path for entry in entries
+                if entry.name.startswith('group__') and entry.name.endswith('.html')
             )
-            for insert_tuple in p:
-                insert_data_list.append(insert_tuple)
-
+    except FileNotFoundError:
+        sys.exit("No `{}` directory in the input docset ({} not found)."
+                 .format(arch.capitalize(), arch_path))
+
+    # Pages were listed from a directory below the documents root, so their
+    # relative path is just what follows the root prefix.
+    prefix_len = len(documents_path) + 1
+
+    # Pages are independent from each other, parse them in parallel.
+    with ProcessPoolExecutor() as executor:
+        results = executor.map(
+            parse_file,
+            [(file_path, file_path[prefix_len:]) for file_path in file_path_list],
+            chunksize=8,
+        )
+        # Entries are deduplicated here rather than by the unique index, so
+        # that the unique index can be built after loading the rows. Keep the
+        # first occurrence, so rows are inserted in page and document order.
+        insert_data_list = list(dict.fromkeys(chain.from_iterable(results)))
+
+    # The database is regenerated from scratch on every run, so durability
+    # guarantees are not needed while bulk loading it.
+    db.execute('PRAGMA journal_mode=MEMORY')
+    db.execute('PRAGMA synchronous=OFF')
     with db:
-        for t in insert_data_list:
-            print("Inserting ", t)
-            db.execute(INSERT_QUERY_TEMPLATE, (t.name, t.type, t.path))
+        db.cursor().executemany(INSERT_QUERY_TEMPLATE, insert_data_list)
+    finalize_db(db)
+    print("Inserted {} entries.".format(len(insert_data_list)))
 
 if __name__ == '__main__':
     main()